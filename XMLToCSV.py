@@ -2,19 +2,48 @@
 
 import argparse
 import csv
+import heapq
+import io
+import mmap
+import multiprocessing
+import operator
 import os
+import pickle
 import re
+import sys
+import tempfile
 import time
+from collections import defaultdict
 from datetime import date, datetime
-from typing import Dict, Tuple, Union
+from functools import lru_cache
+from itertools import chain, groupby
+from typing import Iterable, Tuple, Union
 
 from lxml import etree
 
 __author__ = 'Thom Hurks'
 
+# Number of rows per element that are buffered in memory before being moved to a temporary spill file.
+SPILL_BATCH_SIZE = 10000
+# Number of relation edges that are buffered in memory before being sorted and moved to a temporary spill file.
+EDGE_BATCH_SIZE = 1 << 18
+# Number of sorted relation edges that are stored together in a spill file, and so read at a time when merging.
+EDGE_BLOCK_SIZE = 1 << 12
+# Number of bytes of the memory-mapped XML file that are fed to the parser at a time.
+FEED_BLOCK_SIZE = 1 << 20
+# Buffer size in bytes of the CSV output files.
+OUTPUT_BUFFER_SIZE = 4 << 20
+# The type names that get_type returns.
+TYPE_NAMES = ('any', 'integer', 'float', 'boolean', 'date', 'datetime', 'string')
+# The delimiters of the markup in which a record start tag is just text.
+MARKUP_DELIMITERS = ((b'<!--', b'-->'), (b'<![CDATA[', b']]>'), (b'<?', b'?>'))
+# Matches the characters for which the csv module would quote a value in the semicolon separated output.
+NEEDS_QUOTING = re.compile(r'[;"\r\n]')
+
 
 class InvalidElementName(Exception):
     def __init__(self, invalid_element_name, tag_name, parent_name):
+        super().__init__(invalid_element_name, tag_name, parent_name)
         self.invalid_element_name = invalid_element_name
         self.tag_name = tag_name
         self.parent_name = parent_name
@@ -25,6 +54,22 @@ class InvalidElementName(Exception):
                                                                       repr(self.parent_name))
 
 
+class InvalidXMLChunk(Exception):
+    """Raised by a worker process instead of the lxml error, which cannot be pickled back to the main process. The
+    line numbers in the lxml message count from the start of the part that the worker parsed, so for errors in the XML
+    file the line within the whole file is given as well."""
+
+    def __init__(self, message, line=None):
+        super().__init__(message, line)
+        self.message = message
+        self.line = line
+
+    def __str__(self):
+        if self.line is None:
+            return self.message
+        return '%s (line %d of the XML file)' % (self.message, self.line)
+
+
 def existing_file(filename: str) -> str:
     if os.path.isfile(filename):
         return filename
@@ -32,6 +77,17 @@ def existing_file(filename: str) -> str:
         raise argparse.ArgumentTypeError('%s is not a valid input file!' % filename)
 
 
+def positive_integer(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number > 0:
+        return number
+    else:
+        raise argparse.ArgumentTypeError('%s is not a positive integer' % value)
+
+
 def valid_relation(relation: str) -> tuple:
     parts = [part for part in relation.split(':') if len(part) > 0]
     if len(parts) == 2:
@@ -57,6 +113,14 @@ def parse_args():
                              'the parent element will be created. For example, in order to turn the author attribute '
                              'of the article element into an element with a relation, use "author:authored_by". The '
                              'part after the colon is used as the name of the relation.')
+    parser.add_argument('--no-validate', action='store_false', required=False, dest='validate',
+                        help='Do not validate the XML file against the DTD, which is faster for trusted input. The '
+                             'DTD is still loaded for its entity definitions.')
+    parser.add_argument('--preserve-order', action='store_true', required=False,
+                        help='Keep the values of array cells, such as the authors of an article, in the order of the '
+                             'XML file instead of sorting them.')
+    parser.add_argument('--jobs', action='store', required=False, type=positive_integer, default=1,
+                        help='The number of worker processes that parse parts of the XML file in parallel.')
     parsed_args = parser.parse_args()
     if parsed_args.neo4j:
         if not parsed_args.annotate:
@@ -77,208 +141,501 @@ def parse_args():
 
 
 def get_elements(dtd_file) -> set:
+    """Return the elements that can occur directly within the dblp root element, i.e. the record elements."""
     dtd = etree.DTD(dtd_file)
     elements = set()
+    root_elements = None
     for el in dtd.iterelements():
         if el.type == 'element':
             elements.add(el.name)
+            if el.name == 'dblp':
+                root_elements = get_content_elements(el.content)
     elements.remove('dblp')
+    if root_elements:
+        elements = root_elements
+    return {sys.intern(element) for element in elements}
+
+
+def get_content_elements(content) -> set:
+    elements = set()
+    if content is not None:
+        if content.type == 'element':
+            elements.add(content.name)
+        else:
+            elements.update(get_content_elements(content.left))
+            elements.update(get_content_elements(content.right))
     return elements
 
 
-def open_outputfiles(elements: set, element_attributes: dict, output_filename: str, annotated: bool = False) -> dict:
+def write_outputfiles(spill_files: dict, output_filename: str, annotated: bool = False, jobs: int = 1):
+    arguments = [(element, element_spill_files, output_filename, annotated)
+                 for (element, element_spill_files) in spill_files.items()]
+    if jobs > 1 and len(arguments) > 1:
+        # every element has its own output file, so they can be written side by side
+        with multiprocessing.Pool(processes=min(jobs, len(arguments))) as pool:
+            pool.starmap(write_outputfile, arguments)
+    else:
+        for element_arguments in arguments:
+            write_outputfile(*element_arguments)
+
+
+def write_outputfile(element: str, element_spill_files: list, output_filename: str, annotated: bool = False):
     (path, ext) = os.path.splitext(output_filename)
-    output_files = dict()
-    for element in elements:
-        fieldnames = element_attributes.get(element, None)
-        if fieldnames is not None and len(fieldnames) > 0:
-            fieldnames = sorted(list(fieldnames))
-            fieldnames.insert(0, 'id')
-            output_path = '%s_%s%s' % (path, element, ext)
-            output_file = open(output_path, mode='w', encoding='UTF-8')
-            output_writer = csv.DictWriter(output_file, fieldnames=fieldnames, delimiter=';',
-                                           quoting=csv.QUOTE_MINIMAL, quotechar='"', doublequote=True,
-                                           restval='', extrasaction='raise')
-            if not annotated:
-                output_writer.writeheader()
-            output_files[element] = output_writer
-    return output_files
-
-
-def get_element_attributes(xml_file, elements: set) -> dict:
-    context = etree.iterparse(xml_file, dtd_validation=True, events=('start', 'end'), attribute_defaults=True,
-                              load_dtd=True)
-    # turn it into an iterator
-    context = iter(context)
-    # get the root element
-    event, root = next(context)
-    data = dict()
-    for element in elements:
-        data[element] = set()
-    current_tag = None
-    for event, elem in context:
-        if current_tag is None and event == 'start' and elem.tag in elements:
-            current_tag = elem.tag
-            keys = elem.keys()
-            if len(keys) > 0:
-                keys = set(keys)
-                attributes = data[current_tag]
-                attributes.update(keys)
-        elif current_tag is not None and event == 'end':
-            if elem.tag == current_tag:
-                current_tag = None
-            elif elem.tag is not None and elem.text is not None:
-                if elem.tag == 'id':
-                    raise InvalidElementName('id', elem.tag, current_tag)
-                attributes = data[current_tag]
-                attributes.add(elem.tag)
-                keys = elem.keys()
-                if len(keys) > 0:
-                    for key in keys:
-                        attributes.add('%s-%s' % (elem.tag, key))
-            root.clear()
-    for element in elements:
-        attributes = data[element]
-        if len(attributes) == 0:
-            data.pop(element)
-        elif 'id' in attributes:
-            raise InvalidElementName('id', element, 'root')
-    return data
-
-
-def parse_xml(xml_file, elements: set, output_files: Dict[str, csv.DictWriter], relation_attributes: set,
-              annotate: bool = False) \
-        -> Union[Tuple[dict, int, dict, dict], Tuple[dict, int]]:
-    context = etree.iterparse(xml_file, dtd_validation=True, events=('start', 'end'))
-    # turn it into an iterator
-    context = iter(context)
-    # get the root element
-    event, root = next(context)
-    data = dict()
-    relations = dict()
-    current_tag = None
+    attributes = set()
+    for (spill_path, id_offset, columns) in element_spill_files:
+        attributes.update(columns)
+    fieldnames = sorted(list(attributes))
+    fieldnames.insert(0, 'id')
+    output_path = '%s_%s%s' % (path, element, ext)
+    with open_output_file(output_path) as output_file:
+        # The rows are formatted into a text buffer a batch at a time, and every batch is encoded and written in
+        # one go instead of passing each row separately through a text file layer.
+        text_buffer = io.StringIO(newline='')
+        output_writer = csv.writer(text_buffer, delimiter=';', quoting=csv.QUOTE_MINIMAL, quotechar='"',
+                                   doublequote=True)
+        if not annotated:
+            output_writer.writerow(fieldnames)
+        for (spill_path, id_offset, columns) in element_spill_files:
+            # Rows are stored in the order in which their columns were found, and rows that were buffered before
+            # a column was found are shorter. The slot after the last column is used for missing cells.
+            width = len(columns) + 1
+            # the field order is fixed per spill file, so it is compiled into a single C-level item getter
+            reorder = operator.itemgetter(0, *[columns.get(fieldname, width) for fieldname in fieldnames[1:]])
+            padding = [None] * (width + 1)
+            with open(spill_path, mode='rb') as spill_file:
+                while True:
+                    try:
+                        rows = pickle.load(spill_file)
+                    except EOFError:
+                        break
+                    for row in rows:
+                        row.extend(padding[len(row):])
+                        row[0] += id_offset
+                    output_writer.writerows(map(reorder, rows))
+                    flush_text_buffer(text_buffer, output_file)
+            os.remove(spill_path)
+        flush_text_buffer(text_buffer, output_file)
+
+
+def open_output_file(output_path: str) -> io.BufferedWriter:
+    return io.BufferedWriter(io.FileIO(output_path, mode='w'), buffer_size=OUTPUT_BUFFER_SIZE)
+
+
+def flush_text_buffer(text_buffer: io.StringIO, output_file):
+    output_file.write(text_buffer.getvalue().encode('UTF-8'))
+    text_buffer.seek(0)
+    text_buffer.truncate()
+
+
+def spill_rows(spill_files: dict, spill_directory: str, element: str, rows: list, columns: dict):
+    """Move the buffered rows of an element to its temporary spill file, so memory use stays bounded."""
+    element_spill_files = spill_files.get(element)
+    if element_spill_files is None:
+        spill_path = os.path.join(spill_directory, '%s.pickle' % element)
+        spill_files[element] = element_spill_files = [(spill_path, 0, columns)]
+    (spill_path, id_offset, columns) = element_spill_files[0]
+    with open(spill_path, mode='ab') as spill_file:
+        pickle.dump(rows, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    rows.clear()
+
+
+def read_blocks(xml_data: mmap.mmap, start: int, end: int) -> Iterable[bytes]:
+    for position in range(start, end, FEED_BLOCK_SIZE):
+        yield xml_data[position:min(position + FEED_BLOCK_SIZE, end)]
+
+
+def iterate_events(parser: etree.XMLPullParser, xml_blocks: Iterable[bytes]):
+    """Feed the blocks of XML to the parser and yield its events as soon as they are available."""
+    for block in xml_blocks:
+        parser.feed(block)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def parse_xml(xml_blocks: Iterable[bytes], base_url: str, elements: set, relation_attributes: set,
+              spill_directory: str, annotate: bool = False, preserve_order: bool = False, validate: bool = True) \
+        -> Union[Tuple[dict, dict, int, dict, dict], Tuple[dict, dict, int]]:
+    # Only the end events of the record elements are reported, their contents are read from the finished subtree.
+    # The tree never holds more than a few records, so there is no need to collect XML ids or keep blank text, and
+    # multi-GB files must not run into libxml2's size limits. Comments and processing instructions are kept, as they
+    # end the text of the field they are in. The DTD is found relative to the base URL, as the parser is fed bytes
+    # instead of a file.
+    parser = etree.XMLPullParser(events=('end',), tag=elements, base_url=base_url, dtd_validation=validate,
+                                 load_dtd=True, collect_ids=False, huge_tree=True, remove_blank_text=True)
+    # Per element the index of every column within the rows. Slot 0 of a row holds the id, the other columns get the
+    # next free slot when they are first found.
+    element_columns = dict()
+    buffered_rows = dict()
+    spill_files = dict()
+    # Per relation attribute the edges (value, record id) that are not yet spilled and the spill files of the edges.
+    # The distinct values only become known when the sorted spill files are merged, so they are never all in memory.
+    relations = {column_name: ([], []) for column_name in relation_attributes}
     multiple_valued_cells = set()
+    # the column names of child attributes, by tag and then by attribute, as there are only a few distinct ones
+    attribute_column_names = dict()
     unique_id = 0
+    # the functions that run for every cell are bound to locals, which are cheaper to look up than globals or methods
+    mark_multiple_valued = multiple_valued_cells.add
+    intern = sys.intern
+    any_element = etree.Element
     if annotate:
-        array_elements = dict()
-        element_types = dict()
-    for event, elem in context:
-        if current_tag is None and event == 'start' and elem.tag in elements:
-            current_tag = elem.tag
-            data.clear()
-            multiple_valued_cells.clear()
-            data.update(elem.attrib)
+        array_elements = defaultdict(set)
+        element_types = defaultdict(dict)
+    for event, elem in iterate_events(parser, xml_blocks):
+        # release the records before this one, without touching records that were parsed ahead of it
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        # the attributes are a proxy object that lxml creates anew on every access
+        attrib = elem.attrib
+        if len(elem) == 0 and len(attrib) == 0:
+            # an empty record has no cells, so there is nothing to build
+            continue
+        current_tag = elem.tag
+        columns = element_columns.get(current_tag)
+        if columns is None:
+            element_columns[current_tag] = columns = dict()
+            buffered_rows[current_tag] = []
+        # the columns of the element stay the same object, so its lookup is bound once per record
+        column_index = columns.get
+        row = [None] * (len(columns) + 1)
+        multiple_valued_cells.clear()
+        if annotate:
+            attribute_types = element_types[current_tag]
+        for (key, value) in attrib.items():
+            index = column_index(key)
+            if index is None:
+                if key == 'id':
+                    raise InvalidElementName('id', current_tag, 'root')
+                columns[intern(key)] = len(row)
+                row.append(value)
+            else:
+                row[index] = value
             if annotate:
-                for (key, value) in elem.attrib.items():
-                    set_type_information(element_types, current_tag, key, value)
-        elif current_tag is not None and event == 'end':
-            if elem.tag == current_tag:
-                if len(data) > 0:
-                    set_relation_values(relations, data, relation_attributes, unique_id)
-                    for cell in multiple_valued_cells:
-                        data[cell] = '|'.join(sorted(data[cell]))
-                    data['id'] = unique_id
-                    output_files[current_tag].writerow(data)
-                    if annotate and len(multiple_valued_cells) > 0:
-                        element_cells = array_elements.get(current_tag)
-                        if element_cells is None:
-                            array_elements[current_tag] = multiple_valued_cells.copy()
-                        else:
-                            element_cells.update(multiple_valued_cells)
-                    unique_id += 1
-                current_tag = None
-            elif elem.tag is not None and elem.text is not None:
-                set_cell_value(data, elem.tag, elem.text, multiple_valued_cells)
+                set_type_information(attribute_types, key, value)
+        # the filter skips comments and processing instructions, so every child has a string tag
+        for child in elem.iterdescendants(tag=any_element):
+            value = child.text
+            if value is not None:
+                # the cell bookkeeping is inlined, as it runs for every field of every record
+                column_name = tag = child.tag
+                index = column_index(column_name)
+                if index is None:
+                    if column_name == 'id':
+                        raise InvalidElementName('id', column_name, current_tag)
+                    columns[intern(column_name)] = len(row)
+                    row.append(value)
+                else:
+                    entry = row[index]
+                    if entry is None:
+                        row[index] = value
+                    elif index in multiple_valued_cells:
+                        entry.append(value)
+                    else:
+                        row[index] = [entry, value]
+                        mark_multiple_valued(index)
                 if annotate:
-                    set_type_information(element_types, current_tag, elem.tag, elem.text)
-                for (key, value) in elem.attrib.items():
-                    column_name = '%s-%s' % (elem.tag, key)
-                    set_cell_value(data, column_name, value, multiple_valued_cells)
+                    set_type_information(attribute_types, column_name, value)
+                child_attrib = child.attrib
+                if len(child_attrib) == 0:
+                    continue
+                tag_column_names = attribute_column_names.get(tag)
+                if tag_column_names is None:
+                    attribute_column_names[tag] = tag_column_names = dict()
+                for (key, value) in child_attrib.items():
+                    column_name = tag_column_names.get(key)
+                    if column_name is None:
+                        column_name = intern('%s-%s' % (tag, key))
+                        tag_column_names[key] = column_name
+                    index = column_index(column_name)
+                    if index is None:
+                        columns[column_name] = len(row)
+                        row.append(value)
+                    else:
+                        entry = row[index]
+                        if entry is None:
+                            row[index] = value
+                        elif index in multiple_valued_cells:
+                            entry.append(value)
+                        else:
+                            row[index] = [entry, value]
+                            mark_multiple_valued(index)
                     if annotate:
-                        set_type_information(element_types, current_tag, column_name, value)
-            root.clear()
+                        set_type_information(attribute_types, column_name, value)
+        # records without a single cell are skipped
+        if row.count(None) < len(row):
+            if relations:
+                set_relation_values(relations, spill_directory, row, columns, relation_attributes, unique_id)
+            # many records, e.g. most www records, have no array cells at all
+            if len(multiple_valued_cells) > 0:
+                for index in multiple_valued_cells:
+                    values = row[index]
+                    if len(values) == 2:
+                        # most array cells hold two values, which are concatenated directly in the right order
+                        (first, second) = values
+                        if preserve_order or first <= second:
+                            row[index] = first + '|' + second
+                        else:
+                            row[index] = second + '|' + first
+                    else:
+                        # the value list belongs to this row only, so it is sorted in place
+                        if not preserve_order:
+                            values.sort()
+                        row[index] = '|'.join(values)
+                if annotate:
+                    array_elements[current_tag].update(multiple_valued_cells)
+            row[0] = unique_id
+            rows = buffered_rows[current_tag]
+            rows.append(row)
+            if len(rows) >= SPILL_BATCH_SIZE:
+                spill_rows(spill_files, spill_directory, current_tag, rows, columns)
+            unique_id += 1
+        elem.clear(keep_tail=True)
+    for element, rows in buffered_rows.items():
+        if len(rows) > 0:
+            spill_rows(spill_files, spill_directory, element, rows, element_columns[element])
+    for column_name, (edges, edge_files) in relations.items():
+        if len(edges) > 0:
+            spill_edges(spill_directory, column_name, edges, edge_files)
+    relations = {column_name: edge_files for (column_name, (edges, edge_files)) in relations.items()
+                 if len(edge_files) > 0}
     if annotate:
-        return relations, unique_id, array_elements, element_types
+        # translate the array cells from row slots to column names
+        for element, element_cells in array_elements.items():
+            column_names = [None] + list(element_columns[element])
+            array_elements[element] = {column_names[index] for index in element_cells}
+        return spill_files, relations, unique_id, array_elements, element_types
     else:
-        return relations, unique_id
-
-
-def set_relation_values(relations: dict, data: dict, relation_attributes: set, to_id: int):
-    if len(relation_attributes) == 0:
-        return
-    for column_name, attributes in data.items():
-        if column_name in relation_attributes:
-            relation = relations.get(column_name, dict())
-            if isinstance(attributes, list):
-                for attribute in attributes:
-                    rel_instance = relation.get(attribute, set())
-                    rel_instance.add(to_id)
-                    relation[attribute] = rel_instance
-            else:
-                rel_instance = relation.get(attributes, set())
-                rel_instance.add(to_id)
-                relation[attributes] = rel_instance
-            relations[column_name] = relation
-
-
-def set_cell_value(data: dict, column_name: str, value: str, multiple_valued_cells: set):
-    entry = data.get(column_name)
-    if entry is None:
-        data[column_name] = value
+        return spill_files, relations, unique_id
+
+
+def find_chunks(xml_data: mmap.mmap, elements: set, chunk_count: int) -> Tuple[bytes, list, bytes]:
+    """Split the records of the memory-mapped XML file into byte ranges that start at a record element, and return
+    the header up to and including the root start tag, the ranges and the footer from the root end tag onwards."""
+    root_match = re.search(rb'<dblp[\s>]', xml_data)
+    footer_start = xml_data.rfind(b'</dblp')
+    if root_match is None or footer_start < 0:
+        raise ValueError('No dblp root element found in the XML file')
+    header_end = xml_data.find(b'>', root_match.start()) + 1
+    record_start = re.compile(rb'<(?:%s)[\s>]' % b'|'.join(re.escape(element.encode('UTF-8'))
+                                                          for element in sorted(elements)))
+    boundaries = [header_end]
+    # A record start tag within a comment, CDATA section or processing instruction is just text. The spans of such
+    # markup are found in one forward pass, which is only advanced as far as the candidates need.
+    spans = markup_spans(xml_data, header_end, footer_start)
+    span = next(spans, None)
+    for chunk in range(1, chunk_count):
+        position = max(boundaries[-1], header_end + (footer_start - header_end) * chunk // chunk_count)
+        match = record_start.search(xml_data, position, footer_start)
+        while match is not None:
+            while span is not None and span[1] <= match.start():
+                span = next(spans, None)
+            if span is None or span[0] > match.start():
+                break
+            match = record_start.search(xml_data, span[1], footer_start)
+        if match is not None and match.start() > boundaries[-1]:
+            boundaries.append(match.start())
+    boundaries.append(footer_start)
+    chunks = [(start, end) for (start, end) in zip(boundaries, boundaries[1:])]
+    return xml_data[:header_end], chunks, xml_data[footer_start:]
+
+
+def markup_spans(xml_data: mmap.mmap, start: int, end: int) -> Iterable[Tuple[int, int]]:
+    """Yield the byte ranges of the comments, CDATA sections and processing instructions between the positions, in
+    order. Delimiters within such a range are part of its text, so the search goes on after its own closing delimiter.
+    The start position must lie outside of such markup."""
+    # the next opening delimiter of every kind, which is only searched again once it was passed
+    openings = [xml_data.find(opening, start, end) for (opening, closing) in MARKUP_DELIMITERS]
+    while True:
+        found = [(opened, kind) for (kind, opened) in enumerate(openings) if opened >= 0]
+        if len(found) == 0:
+            return
+        (opened, kind) = min(found)
+        (opening, closing) = MARKUP_DELIMITERS[kind]
+        closed = xml_data.find(closing, opened + len(opening), end)
+        if closed < 0:
+            # unclosed markup runs up to the end
+            yield opened, end
+            return
+        position = closed + len(closing)
+        yield opened, position
+        for (kind, next_opened) in enumerate(openings):
+            if 0 <= next_opened < position:
+                openings[kind] = xml_data.find(MARKUP_DELIMITERS[kind][0], position, end)
+
+
+def parse_xml_chunk(xml_filename: str, header: bytes, start: int, end: int, footer: bytes, elements: set,
+                    relation_attributes: set, spill_directory: str, annotate: bool = False,
+                    preserve_order: bool = False, validate: bool = True):
+    os.mkdir(spill_directory)
+    with open(xml_filename, mode='rb') as xml_file, \
+            mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as xml_data:
+        # the byte range is framed by the header and footer of the file, so it is parsed as a document of its own
+        xml_blocks = chain((header,), read_blocks(xml_data, start, end), (footer,))
+        try:
+            return parse_xml(xml_blocks, xml_filename, elements, relation_attributes, spill_directory, annotate,
+                             preserve_order, validate)
+        except etree.LxmlError as e:
+            if getattr(e, 'filename', None) != xml_filename:
+                # e.g. an error in the DTD, whose line numbers are its own
+                raise InvalidXMLChunk(str(e))
+            # The part starts on the line where its header ends. The newlines before it are counted a block at a
+            # time, so the mapped file is not copied.
+            line = (e.lineno or 1) - header.count(b'\n')
+            line += sum(block.count(b'\n') for block in read_blocks(xml_data, 0, start))
+            raise InvalidXMLChunk(str(e), line)
+
+
+def parse_xml_parallel(xml_filename: str, elements: set, relation_attributes: set, spill_directory: str, jobs: int,
+                       annotate: bool = False, preserve_order: bool = False, validate: bool = True) \
+        -> Union[Tuple[dict, dict, int, dict, dict], Tuple[dict, dict, int]]:
+    # The file is memory-mapped, so the workers share the pages that the kernel already read for the boundary search.
+    with open(xml_filename, mode='rb') as xml_file, \
+            mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as xml_data:
+        (header, chunks, footer) = find_chunks(xml_data, elements, jobs)
+    arguments = [(xml_filename, header, start, end, footer, elements, relation_attributes,
+                  os.path.join(spill_directory, 'chunk%d' % index), annotate, preserve_order, validate)
+                 for (index, (start, end)) in enumerate(chunks)]
+    with multiprocessing.Pool(processes=jobs) as pool:
+        results = pool.starmap(parse_xml_chunk, arguments)
+    return merge_chunk_results(results, annotate)
+
+
+def merge_chunk_results(results: list, annotate: bool = False) \
+        -> Union[Tuple[dict, dict, int, dict, dict], Tuple[dict, dict, int]]:
+    """Combine the results of the chunks, in document order, as if the XML file was parsed in one go. The ids of each
+    chunk start at zero, so they are offset by the number of records in the chunks before it."""
+    spill_files = defaultdict(list)
+    relations = dict()
+    unique_id = 0
+    array_elements = defaultdict(set)
+    element_types = defaultdict(dict)
+    for result in results:
+        (chunk_spill_files, chunk_relations, chunk_unique_id) = result[:3]
+        for element, element_spill_files in chunk_spill_files.items():
+            spill_files[element].extend((spill_path, id_offset + unique_id, columns)
+                                        for (spill_path, id_offset, columns) in element_spill_files)
+        for column_name, chunk_edge_files in chunk_relations.items():
+            relations.setdefault(column_name, []).extend((edge_path, id_offset + unique_id)
+                                                         for (edge_path, id_offset) in chunk_edge_files)
+        if annotate:
+            (chunk_array_elements, chunk_element_types) = result[3:]
+            for element, cells in chunk_array_elements.items():
+                array_elements[element].update(cells)
+            for element, column_types in chunk_element_types.items():
+                attribute_types = element_types[element]
+                for column_name, column_type in column_types.items():
+                    attribute_types[column_name] = combine_types(attribute_types.get(column_name, 'any'), column_type)
+        unique_id += chunk_unique_id
+    if annotate:
+        return spill_files, relations, unique_id, array_elements, element_types
     else:
-        if isinstance(entry, list):
-            entry.append(value)
+        return spill_files, relations, unique_id
+
+
+def set_relation_values(relations: dict, spill_directory: str, row: list, columns: dict, relation_attributes: set,
+                        to_id: int):
+    for column_name in relation_attributes:
+        index = columns.get(column_name)
+        if index is None or row[index] is None:
+            continue
+        attributes = row[index]
+        (edges, edge_files) = relations[column_name]
+        if isinstance(attributes, list):
+            edges.extend((attribute, to_id) for attribute in set(attributes))
         else:
-            data[column_name] = [entry, value]
-            multiple_valued_cells.add(column_name)
+            edges.append((attributes, to_id))
+        if len(edges) >= EDGE_BATCH_SIZE:
+            spill_edges(spill_directory, column_name, edges, edge_files)
+
+
+def spill_edges(spill_directory: str, column_name: str, edges: list, edge_files: list):
+    """Sort the buffered edges of a relation by value and move them to a new temporary spill file, in blocks that can
+    be read back one at a time."""
+    edges.sort()
+    edge_path = os.path.join(spill_directory, '%s.%d.edges' % (column_name, len(edge_files)))
+    with open(edge_path, mode='wb') as edge_file:
+        for start in range(0, len(edges), EDGE_BLOCK_SIZE):
+            pickle.dump(edges[start:start + EDGE_BLOCK_SIZE], edge_file, protocol=pickle.HIGHEST_PROTOCOL)
+    edge_files.append((edge_path, 0))
+    edges.clear()
+
+
+def read_edges(edge_path: str, id_offset: int):
+    """Yield the sorted edges of a spill file, with the offset added to their record ids, and remove the file."""
+    with open(edge_path, mode='rb') as edge_file:
+        while True:
+            try:
+                edges = pickle.load(edge_file)
+            except EOFError:
+                break
+            if id_offset == 0:
+                yield from edges
+            else:
+                for (value, from_id) in edges:
+                    yield value, from_id + id_offset
+    os.remove(edge_path)
+
+
+def set_type_information(attribute_types: dict, column_name: str, value: str):
+    column_type = attribute_types.get(column_name, 'any')
+    # a column that holds a string is a string column whatever else it holds, so its values need no more typing
+    if column_type != 'string':
+        attribute_types[column_name] = TYPE_TRANSITIONS[column_type][get_type(value)]
+
+
+def combine_types(column_type: str, value_type: str) -> str:
+    """Return the type of a column after a value of the given type was added to it. The empty type 'any' fits every
+    column, integers widen to floats and dates to datetimes, and any other mix of types makes a string column."""
+    if value_type == column_type or value_type == 'any':
+        return column_type
+    elif column_type == 'any':
+        return value_type
+    elif {column_type, value_type} == {'integer', 'float'}:
+        return 'float'
+    elif {column_type, value_type} == {'date', 'datetime'}:
+        return 'datetime'
+    return 'string'
 
 
-def set_type_information(element_types: dict, current_tag: str, column_name: str, value: str):
-    attribute_types = element_types.get(current_tag)
-    if attribute_types is None:
-        element_types[current_tag] = attribute_types = dict()
-    types = attribute_types.get(column_name)
-    if types is None:
-        attribute_types[column_name] = types = set()
-    types.add(get_type(value))
+# The types combined up front, by column type and then by value type, so typing a value is two dict lookups.
+TYPE_TRANSITIONS = {column_type: {value_type: combine_types(column_type, value_type) for value_type in TYPE_NAMES}
+                    for column_type in TYPE_NAMES}
 
 
+@lru_cache(maxsize=1 << 16)
 def get_type(string_value: str) -> str:
-    """Attempt to handle types int, float, boolean and string, nothing more complex since output is CSV."""
+    """Attempt to handle types int, float, boolean and string, nothing more complex since output is CSV. Values such as
+    years, months and volumes repeat a lot, so the results are cached."""
     if string_value is None or len(string_value) == 0:
         return 'any'
-    if str.isdigit(string_value):
-        try:
-            int(string_value)
-            return 'integer'
-        except ValueError:
-            return 'string'
-    if get_type.re_number.fullmatch(string_value) is not None:
-        try:
-            float(string_value)
-            return 'float'
-        except ValueError:
-            return 'string'
-    if get_type.re_date.fullmatch(string_value) is not None:
-        try:
-            date.fromisoformat(string_value)
-            return 'date'
-        except ValueError:
-            return 'string'
-    if get_type.re_datetime.fullmatch(string_value) is not None:
+    first_character = string_value[0]
+    if not first_character.isdigit():
+        # Only booleans can start with something other than a digit; this settles most text values right away.
+        if first_character in 'tTfF' and string_value.lower() in ('true', 'false'):
+            return 'boolean'
+        return 'string'
+    if string_value.isdigit():
+        # int() accepts exactly the decimal digits, isdigit() also holds for e.g. superscripts
+        return 'integer' if string_value.isdecimal() else 'string'
+    (integer_part, dot, fraction_part) = string_value.partition('.')
+    if dot and integer_part.isdecimal() and fraction_part.isdecimal():
+        return 'float'
+    # dates and datetimes share their prefix, so a single match tells them apart by whether the time group is set
+    match = get_type.re_date_time.fullmatch(string_value)
+    if match is not None:
         try:
+            if match.lastgroup is None:
+                date.fromisoformat(string_value)
+                return 'date'
             datetime.fromisoformat(string_value)
             return 'datetime'
         except ValueError:
             return 'string'
-    if string_value.lower() == 'true' or string_value.lower() == 'false':
-        return 'boolean'
     return 'string'
 
 
-get_type.re_number = re.compile(r'^\d+\.\d+$')
-get_type.re_date = re.compile(r'^\d{4}-\d{2}-\d{2}$')
-get_type.re_datetime = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?$')
+get_type.re_date_time = re.compile(r'\d{4}-\d{2}-\d{2}(?P<time> \d{2}:\d{2}(?::\d{2})?)?')
 
 
 def write_annotated_header(array_elements: dict, element_types: dict, output_filename: str, neo4j_style: bool = False):
@@ -292,11 +649,11 @@ def write_annotated_header(array_elements: dict, element_types: dict, output_fil
             header.append('%s:ID' % element)
         else:
             columns.insert(0, 'id')
-            column_types['id'] = {int}
+            column_types['id'] = 'integer'
         for column in columns:
-            types = column_types[column]
-            high_level_type = get_high_level_type(types)
-            typename = translate_type(high_level_type, neo4j_style)
+            # a column that only holds empty values has no type of its own
+            column_type = column_types[column]
+            typename = translate_type('string' if column_type == 'any' else column_type, neo4j_style)
             if column in array_columns:
                 header.append('%s:%s[]' % (column, typename))
             else:
@@ -311,26 +668,6 @@ def translate_type(type_input: str, neo4j_style: bool = False) -> str:
     return type_input
 
 
-def get_high_level_type(types: set) -> str:
-    if len(types) == 0:
-        raise Exception('Empty type set encountered', types)
-    types.discard('any')
-    if len(types) == 0:
-        return 'string'
-    elif len(types) == 1:
-        (high_level_type,) = types
-        return high_level_type
-    else:
-        if 'string' in types:
-            return 'string'
-        elif len(types) == 2:
-            if 'float' in types and 'integer' in types:
-                return 'float'
-            elif 'date' in types and 'datetime' in types:
-                return 'datetime'
-    return 'string'
-
-
 def generate_neo4j_import_command(elements: set, relations: set, relation_alias: dict, output_filename: str):
     (path, ext) = os.path.splitext(output_filename)
     command = 'neo4j-admin import --mode=csv --database=dblp.db --delimiter ";" --array-delimiter "|" ' \
@@ -345,21 +682,45 @@ def generate_neo4j_import_command(elements: set, relations: set, relation_alias:
 
 
 def write_relation_files(output_filename: str, relations: dict, relation_alias: dict, unique_id: int):
+    """Write the node and edge file of every relation. The sorted spill files of a relation are merged, so the edges of
+    every distinct value arrive together. The values get the ids after those of the elements and of the nodes of the
+    relations before them, in sorted order."""
     (path, ext) = os.path.splitext(output_filename)
-    for column_name, relation in relations.items():
+    needs_quoting = NEEDS_QUOTING.search
+    # the relations are written in the order in which they were given, which fixes the id ranges of their nodes
+    for column_name in relation_alias:
+        edge_files = relations.get(column_name)
+        if edge_files is None:
+            continue
         output_path_node = '%s_%s%s' % (path, column_name, ext)
         output_path_relation = '%s_%s_%s%s' % (path, column_name, relation_alias[column_name], ext)
-        with open(output_path_relation, mode='w', encoding='UTF-8') as output_file_relation:
-            output_file_relation.write(':START_ID;:END_ID\n')
-            with open(output_path_node, mode='w', encoding='UTF-8') as output_file_node:
-                node_output_writer = csv.writer(output_file_node, delimiter=';', quoting=csv.QUOTE_MINIMAL,
-                                                quotechar='"', doublequote=True)
-                output_file_node.write(':ID;%s:string\n' % column_name)
-                for value, rel_instance in relation.items():
-                    node_output_writer.writerow([unique_id, value])
-                    for from_id in rel_instance:
-                        output_file_relation.write('%d;%d\n' % (from_id, unique_id))
-                    unique_id += 1
+        # a whole batch of rows is encoded and written with a single call, like the element rows
+        with open_output_file(output_path_node) as output_file_node, \
+                open_output_file(output_path_relation) as output_file_relation:
+            output_file_node.write((':ID;%s:string\n' % column_name).encode('UTF-8'))
+            output_file_relation.write(b':START_ID;:END_ID\n')
+            edges = heapq.merge(*[read_edges(edge_path, id_offset) for (edge_path, id_offset) in edge_files])
+            node_lines = []
+            edge_lines = []
+            from_id_getter = operator.itemgetter(1)
+            node_id = unique_id - 1
+            for (node_id, (value, value_edges)) in enumerate(groupby(edges, key=operator.itemgetter(0)), unique_id):
+                # The rows only have an id and a value, so they are formatted directly, quoted like the csv module
+                # would.
+                node_lines.append('%d;%s\r\n' % (node_id, value if needs_quoting(value) is None
+                                                  else '"%s"' % value.replace('"', '""')))
+                # all edges of a node end the same way, so they are joined on that ending in one go
+                edge_end = ';%d\n' % node_id
+                edge_lines.append(edge_end.join(map(str, map(from_id_getter, value_edges))) + edge_end)
+                if len(node_lines) >= EDGE_BLOCK_SIZE:
+                    output_file_node.write(''.join(node_lines).encode('UTF-8'))
+                    output_file_relation.write(''.join(edge_lines).encode('UTF-8'))
+                    node_lines.clear()
+                    edge_lines.clear()
+            output_file_node.write(''.join(node_lines).encode('UTF-8'))
+            output_file_relation.write(''.join(edge_lines).encode('UTF-8'))
+        # the nodes of the next relation get the ids after these, so that no two nodes share an id
+        unique_id = node_id + 1
 
 
 def main():
@@ -370,29 +731,34 @@ def main():
         with open(args.dtd_filename, mode='rb') as dtd_file:
             print('Reading elements from DTD file...')
             elements = get_elements(dtd_file)
-        with open(args.xml_filename, mode='rb') as xml_file:
-            print('Finding unique attributes for all elements...')
+        array_elements = None
+        element_types = None
+        relation_attributes = set(args.relations.keys())
+        with tempfile.TemporaryDirectory() as spill_directory:
             try:
-                element_attributes = get_element_attributes(xml_file, elements)
+                if args.jobs > 1:
+                    print('Parsing XML in %d parallel jobs and buffering rows...' % args.jobs)
+                    result = parse_xml_parallel(args.xml_filename, elements, relation_attributes, spill_directory,
+                                                args.jobs, args.annotate, args.preserve_order, args.validate)
+                else:
+                    with open(args.xml_filename, mode='rb') as xml_file, \
+                            mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as xml_data:
+                        print('Parsing XML and buffering rows...')
+                        result = parse_xml(read_blocks(xml_data, 0, len(xml_data)), args.xml_filename, elements,
+                                           relation_attributes, spill_directory, args.annotate, args.preserve_order,
+                                           args.validate)
             except InvalidElementName as e:
-                element_attributes = None
                 print(e)
                 exit(1)
-        print('Opening output files...')
-        output_files = open_outputfiles(elements, element_attributes, args.outputfile, args.annotate)
-        array_elements = None
-        element_types = None
-        with open(args.xml_filename, mode='rb') as xml_file:
-            print('Parsing XML and writing to CSV files...')
-            relation_attributes = set(args.relations.keys())
             if args.annotate:
-                (relations, unique_id, array_elements, element_types) = parse_xml(xml_file, elements, output_files,
-                                                                                  relation_attributes, annotate=True)
+                (spill_files, relations, unique_id, array_elements, element_types) = result
             else:
-                relations, unique_id = parse_xml(xml_file, elements, output_files, relation_attributes)
-        if args.relations and relations and unique_id >= 0:
-            print('Writing relation files...')
-            write_relation_files(args.outputfile, relations, args.relations, unique_id)
+                (spill_files, relations, unique_id) = result
+            print('Writing CSV files...')
+            write_outputfiles(spill_files, args.outputfile, args.annotate, args.jobs)
+            if args.relations and relations and unique_id >= 0:
+                print('Writing relation files...')
+                write_relation_files(args.outputfile, relations, args.relations, unique_id)
         if args.annotate and array_elements and element_types:
             print('Writing annotated headers...')
             write_annotated_header(array_elements, element_types, args.outputfile, args.neo4j)